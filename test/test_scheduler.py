@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the per-device request scheduler, driven against a fake device and
+a fake clock.
+"""
+import threading
+import time
+import pytest
+import requests
+from upnpy import scheduler
+from upnpy.scheduler import Scheduler, CircuitOpenError
+
+URL = 'http://192.168.0.1:5000/ctl'
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeDevice(object):
+    """
+    A fake session. Each request takes ``latency`` seconds and then either
+    returns a response with ``status_code`` or raises ``error``.
+    """
+    def __init__(self, clock, latency=0.01, status_code=200):
+        self.clock = clock
+        self.latency = latency
+        self.status_code = status_code
+        self.error = None
+        self.requests = 0
+
+    def request(self, method, url, **kwargs):
+        self.requests += 1
+        self.clock.now += self.latency
+
+        if self.error is not None:
+            raise self.error
+
+        return FakeResponse(self.status_code)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def device(clock):
+    return FakeDevice(clock)
+
+
+@pytest.fixture
+def sched(clock, device):
+    return Scheduler(session=device, clock=clock, sleep=clock.sleep)
+
+
+def state(sched):
+    return sched.device_state(URL)
+
+
+def fail(sched, n):
+    for _ in range(n):
+        with pytest.raises(requests.RequestException):
+            sched.get(URL)
+
+
+class TestRate(object):
+    def test_rate_grows_while_healthy(self, sched):
+        for _ in range(20):
+            sched.post(URL)
+
+        assert state(sched).rate > scheduler.INITIAL_RATE
+
+    def test_requests_are_spaced_out(self, sched, clock):
+        start = clock.now
+        sched.get(URL)
+        sched.get(URL)
+
+        assert clock.now - start >= 1.0 / scheduler.INITIAL_RATE
+
+    def test_rate_backs_off_on_503(self, sched, device):
+        sched.get(URL)
+        before = state(sched).rate
+
+        device.status_code = 503
+        sched.get(URL)
+
+        assert state(sched).rate < before
+
+    def test_rate_backs_off_on_slow_responses(self, sched, device):
+        for _ in range(10):
+            sched.get(URL)
+        before = state(sched).rate
+
+        device.latency *= 10
+        for _ in range(5):
+            sched.get(URL)
+
+        assert state(sched).rate < before
+
+    def test_mixed_request_kinds_are_not_strained(self, sched, device):
+        for _ in range(50):
+            device.latency = 0.005
+            sched.post(URL)
+            device.latency = 0.05
+            sched.get('http://192.168.0.1:5000/desc.xml')
+
+        assert state(sched).rate == scheduler.MAX_RATE
+
+    def test_fast_outlier_is_not_strain(self, sched, device):
+        for _ in range(200):
+            sched.post(URL)
+        assert state(sched).rate == scheduler.MAX_RATE
+
+        device.latency = 0.001
+        sched.post(URL)
+        device.latency = 0.01
+
+        for _ in range(20):
+            sched.post(URL)
+            assert state(sched).rate == scheduler.MAX_RATE
+
+    def test_500_is_not_a_failure(self, sched, device):
+        device.status_code = 500
+
+        for _ in range(scheduler.FAILURE_THRESHOLD + 1):
+            sched.post(URL)
+
+        assert state(sched).failures == 0
+        assert state(sched).state == scheduler.CLOSED
+        assert state(sched).rate > scheduler.INITIAL_RATE
+
+    def test_connection_errors_do_not_lower_ceiling(self, sched, device):
+        device.error = requests.ConnectionError()
+        fail(sched, 1)
+
+        assert state(sched).ceiling == scheduler.MAX_RATE
+
+    def test_503_lowers_ceiling(self, sched, device):
+        device.status_code = 503
+        sched.get(URL)
+
+        assert state(sched).ceiling < scheduler.MAX_RATE
+
+
+class TestCircuitBreaker(object):
+    def test_opens_after_threshold(self, sched, device):
+        device.error = requests.ConnectionError()
+        fail(sched, scheduler.FAILURE_THRESHOLD)
+
+        assert state(sched).state == scheduler.OPEN
+
+        requests_so_far = device.requests
+        with pytest.raises(CircuitOpenError):
+            sched.get(URL)
+        assert device.requests == requests_so_far
+
+    def test_half_open_probe_closes_on_success(self, sched, device, clock):
+        device.error = requests.ConnectionError()
+        fail(sched, scheduler.FAILURE_THRESHOLD)
+
+        clock.now += scheduler.RESET_TIMEOUT
+        device.error = None
+        sched.get(URL)
+
+        assert state(sched).state == scheduler.CLOSED
+        assert state(sched).rate >= scheduler.INITIAL_RATE
+        assert state(sched).ceiling >= scheduler.INITIAL_RATE
+
+    def test_failed_probe_doubles_reset_timeout(self, sched, device, clock):
+        device.error = requests.ConnectionError()
+        fail(sched, scheduler.FAILURE_THRESHOLD)
+
+        clock.now += scheduler.RESET_TIMEOUT
+        fail(sched, 1)
+        assert state(sched).state == scheduler.OPEN
+
+        # The first reset timeout is no longer long enough...
+        clock.now += scheduler.RESET_TIMEOUT
+        with pytest.raises(CircuitOpenError):
+            sched.get(URL)
+
+        # ...but twice that is.
+        clock.now += scheduler.RESET_TIMEOUT
+        device.error = None
+        sched.get(URL)
+        assert state(sched).state == scheduler.CLOSED
+
+    def test_interrupted_probe_does_not_stick(self, sched, device, clock):
+        device.error = requests.ConnectionError()
+        fail(sched, scheduler.FAILURE_THRESHOLD)
+
+        clock.now += scheduler.RESET_TIMEOUT
+        device.error = KeyboardInterrupt()
+        with pytest.raises(KeyboardInterrupt):
+            sched.get(URL)
+
+        assert state(sched).state == scheduler.OPEN
+
+        device.error = None
+        sched.get(URL)
+        assert state(sched).state == scheduler.CLOSED
+
+    def test_caller_errors_are_not_failures(self, sched, device):
+        device.error = requests.exceptions.MissingSchema()
+
+        for _ in range(scheduler.FAILURE_THRESHOLD):
+            with pytest.raises(requests.exceptions.MissingSchema):
+                sched.get(URL)
+
+        assert state(sched).failures == 0
+        assert state(sched).state == scheduler.CLOSED
+
+    def test_queued_requests_are_refused_once_open(self, monkeypatch):
+        # Let every thread get a slot straight away, so they all queue up on
+        # the in-flight limit behind a device that refuses connections.
+        monkeypatch.setattr(scheduler, 'INITIAL_RATE', 10000.0)
+
+        class RefusingDevice(object):
+            def __init__(self):
+                self.requests = 0
+                self.lock = threading.Lock()
+
+            def request(self, method, url, **kwargs):
+                with self.lock:
+                    self.requests += 1
+                time.sleep(0.01)
+                raise requests.ConnectionError()
+
+        device = RefusingDevice()
+        sched = Scheduler(session=device)
+        errors = []
+
+        def send():
+            try:
+                sched.get(URL)
+            except CircuitOpenError as e:
+                errors.append(e)
+            except requests.ConnectionError:
+                pass
+
+        threads = [threading.Thread(target=send) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert device.requests == scheduler.FAILURE_THRESHOLD
+        assert len(errors) == 20 - scheduler.FAILURE_THRESHOLD
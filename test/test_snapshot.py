@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for device topology snapshots, and restoring them into a control point.
+"""
+import struct
+import time
+import xml.etree.ElementTree as ElementTree
+import pytest
+import requests
+from upnpy import scheduler, snapshot
+from upnpy.controlpoint import (ControlPoint, device_map,
+                                device_from_httpu_response)
+from upnpy.httpu import HTTPUResponse
+from upnpy.device import Device, GatewayDeviceV1
+from upnpy.device.wandevice import WANDeviceV1
+from upnpy.service import WANIPConnectionV1
+from upnpy.servicemapping import init_service
+
+IGD = 'urn:schemas-upnp-org:device:InternetGatewayDevice:1'
+WAN_DEVICE = 'urn:schemas-upnp-org:device:WANDevice:1'
+WAN_IP = 'urn:schemas-upnp-org:service:WANIPConnection:1'
+
+SERVICE_XML = u"""
+<service xmlns="urn:schemas-upnp-org:device-1-0">
+  <serviceType>%s</serviceType>
+  <serviceId>urn:upnp-org:serviceId:WANIPConn1</serviceId>
+  <SCPDURL>/WANIPCn.xml</SCPDURL>
+  <controlURL>%s</controlURL>
+  <eventSubURL>/upnp/event/WANIPConn1</eventSubURL>
+</service>
+"""
+
+DESCRIPTION_XML = u"""<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+  <device>
+    <deviceType>%s</deviceType>
+    <friendlyName>Router</friendlyName>
+    <UDN>%s</UDN>
+    <deviceList>
+      <device>
+        <deviceType>%s</deviceType>
+        <UDN>uuid:wan</UDN>
+        <serviceList>%s</serviceList>
+      </device>
+    </deviceList>
+  </device>
+</root>
+"""
+
+
+def make_gateway(location='http://192.168.0.1:5000/rootDesc.xml',
+                 udn='uuid:igd'):
+    """
+    Build a described gateway device with one WAN sub-device, which has one
+    WANIPConnection service.
+    """
+    gateway = GatewayDeviceV1()
+    gateway.server = u'Linux/3.14 UPnP/1.0 MiniUPnPd/1.9'
+    gateway.service_name = udn + u'::' + IGD
+    gateway.search_target = IGD
+    gateway.location = location
+    gateway.source_ip = u'192.168.0.1'
+    gateway.source_port = 5000
+    gateway.base_url = u'http://192.168.0.1:5000'
+    gateway.device_type = IGD
+    gateway.friendly_name = u'Büro-Router ☃'
+    gateway.udn = udn
+
+    wan = WANDeviceV1()
+    wan.parent = gateway
+    wan.server = gateway.server
+    wan.source_ip = gateway.source_ip
+    wan.source_port = gateway.source_port
+    wan.base_url = gateway.base_url
+    wan.device_type = WAN_DEVICE
+    gateway.devices.append(wan)
+
+    node = ElementTree.fromstring(SERVICE_XML % (WAN_IP, '/ctl/IPConn'))
+    namespace = node.tag.replace('service', '')
+    wan.services.append(init_service(wan, node, WAN_IP, namespace))
+
+    return gateway
+
+
+class FakeResponse(object):
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(self.status_code)
+
+
+def discovery_response(search_target, usn,
+                       location='http://192.168.0.1:5000/rootDesc.xml'):
+    """
+    Build the device for a single response to an ssdp:all search.
+    """
+    datagram = '\r\n'.join(['HTTP/1.1 200 OK',
+                             'SERVER: Linux UPnP/1.0 MiniUPnPd/1.9',
+                             'ST: ' + search_target,
+                             'USN: ' + usn,
+                             'LOCATION: ' + location,
+                             '', ''])
+    response = HTTPUResponse.from_datagram(datagram, ('192.168.0.1', 5000))
+    return device_from_httpu_response(response)
+
+
+def description(udn, control_url):
+    service = SERVICE_XML % (WAN_IP, control_url)
+    return DESCRIPTION_XML % (IGD, udn, WAN_DEVICE, service)
+
+
+class TestSnapshot(object):
+    def test_round_trip(self):
+        data = snapshot.dumps([make_gateway()])
+        restored = snapshot.loads(data, device_map)
+
+        [gateway] = restored.devices()
+        assert isinstance(gateway, GatewayDeviceV1)
+        assert gateway.location == 'http://192.168.0.1:5000/rootDesc.xml'
+        assert gateway.base_url == 'http://192.168.0.1:5000'
+        assert gateway.source_port == 5000
+        assert gateway.friendly_name == u'Büro-Router ☃'
+        assert gateway.parent is None
+
+        [wan] = gateway.devices
+        assert isinstance(wan, WANDeviceV1)
+        assert wan.parent is gateway
+        assert wan.base_url == 'http://192.168.0.1:5000'
+        assert wan.source_port == 5000
+
+        [service] = wan.services
+        assert isinstance(service, WANIPConnectionV1)
+        assert service.parent is wan
+        assert service.control_url == '/ctl/IPConn'
+        assert service.event_sub_url == '/upnp/event/WANIPConn1'
+
+    def test_absent_attributes_stay_absent(self):
+        device = Device()
+        device.location = 'http://192.168.0.2/desc.xml'
+
+        [restored] = snapshot.loads(snapshot.dumps([device])).devices()
+
+        assert restored.source_port is None
+        assert not hasattr(restored, 'base_url')
+
+    def test_rejects_bad_magic(self):
+        data = snapshot.dumps([make_gateway()])
+
+        with pytest.raises(ValueError):
+            snapshot.loads(b'NOTASNAP' + data[8:])
+
+    def test_rejects_wrong_version(self):
+        data = snapshot.dumps([make_gateway()])
+        data = data[:8] + struct.pack('>B', snapshot.VERSION + 1) + data[9:]
+
+        with pytest.raises(ValueError):
+            snapshot.loads(data)
+
+    @pytest.mark.parametrize('length', [0, 5, 20, 40])
+    def test_rejects_truncated_input(self, length):
+        data = snapshot.dumps([make_gateway()])
+
+        with pytest.raises(ValueError):
+            snapshot.loads(data[:length])
+
+    def test_rejects_truncated_records(self):
+        data = snapshot.dumps([make_gateway()])
+
+        with pytest.raises(ValueError):
+            snapshot.loads(data[:-1])
+
+    def test_decoding_is_lazy(self):
+        decoded = []
+
+        class CountingGateway(GatewayDeviceV1):
+            def __init__(self):
+                super(CountingGateway, self).__init__()
+                decoded.append(self)
+
+        first = make_gateway('http://192.168.0.1:5000/a.xml')
+        second = make_gateway('http://192.168.0.1:5000/b.xml')
+        data = snapshot.dumps([first, second])
+
+        restored = snapshot.loads(data, {IGD: CountingGateway})
+        assert len(restored) == 2
+        assert decoded == []
+
+        device = restored.device('http://192.168.0.1:5000/b.xml')
+        assert decoded == [device]
+
+        # Decoded devices are cached.
+        assert restored.device('http://192.168.0.1:5000/b.xml') is device
+        assert len(decoded) == 1
+
+    def test_discard_during_iteration(self):
+        locations = ['http://192.168.0.%d:5000/desc.xml' % i
+                     for i in range(1, 4)]
+        data = snapshot.dumps([make_gateway(l) for l in locations])
+        restored = snapshot.loads(data, device_map)
+
+        seen = []
+        for location in restored.locations:
+            restored.discard(locations[2])
+            try:
+                seen.append(restored.device(location).location)
+            except KeyError:
+                pass
+
+        assert seen == locations[:2]
+        assert restored.locations == locations[:2]
+        assert [d.location for d in restored.devices()] == locations[:2]
+
+    def test_corrupt_record_is_discarded(self):
+        good = make_gateway('http://192.168.0.1:5000/a.xml')
+        bad = make_gateway('http://192.168.0.1:5000/b.xml')
+        data = bytearray(snapshot.dumps([bad, good]))
+
+        # Both records are the same length, and sit at the end of the data.
+        record = bytearray()
+        snapshot._encode_device(good, snapshot._StringTable(), record)
+        start = len(data) - (2 * len(record))
+
+        # Point the bad record's first string reference past the table.
+        data[start] = 0x7F
+        restored = snapshot.loads(bytes(data), device_map)
+        assert len(restored) == 2
+
+        with pytest.raises(KeyError):
+            restored.device(bad.location)
+
+        assert restored.locations == [good.location]
+        assert [d.location for d in restored.devices()] == [good.location]
+
+    def test_record_must_end_at_its_length(self):
+        device = make_gateway()
+        data = bytearray(snapshot.dumps([device]))
+
+        # Claim the device has no sub-devices, leaving trailing bytes.
+        record = bytearray()
+        snapshot._encode_device(device, snapshot._StringTable(), record)
+        start = len(data) - len(record)
+        # The gateway's fields, then a two byte port and no services.
+        sub_device_count = start + len(snapshot.DEVICE_FIELDS) + 2 + 1
+        assert data[sub_device_count] == 1
+        data[sub_device_count] = 0
+
+        restored = snapshot.loads(bytes(data), device_map)
+        assert restored.devices() == []
+
+    def test_verified_times_are_per_device(self):
+        fresh = make_gateway('http://192.168.0.1:5000/a.xml')
+        stale = make_gateway('http://192.168.0.1:5000/b.xml')
+        now = time.time()
+
+        data = snapshot.dumps([fresh, stale], timestamp=now,
+                              verified={stale.location: now - 3600})
+        restored = snapshot.loads(data)
+
+        assert restored.stale(300) == [stale.location]
+
+
+class TestControlPointSnapshots(object):
+    @pytest.fixture
+    def get(self, monkeypatch):
+        """
+        Replace scheduled GETs with a dictionary of location URLs to
+        responses. Locations not in the dictionary 404.
+        """
+        responses = {}
+        calls = []
+
+        def fake_get(url, **kwargs):
+            calls.append(url)
+            return responses.get(url, FakeResponse('', 404))
+
+        monkeypatch.setattr(scheduler, 'get', fake_get)
+        fake_get.responses = responses
+        fake_get.calls = calls
+        return fake_get
+
+    def test_fresh_snapshot_is_not_revalidated(self, get):
+        cp = ControlPoint()
+        thread = cp.load_snapshot(snapshot.dumps([make_gateway()]))
+
+        assert thread is None
+        assert get.calls == []
+        assert len(cp.devices) == 1
+
+    def test_stale_snapshot_is_revalidated(self, get):
+        alive = make_gateway('http://192.168.0.1:5000/a.xml', 'uuid:a')
+        gone = make_gateway('http://192.168.0.2:5000/b.xml', 'uuid:b')
+        get.responses[alive.location] = FakeResponse(
+            description('uuid:a', '/ctl/moved'))
+
+        data = snapshot.dumps([alive, gone], timestamp=time.time() - 3600)
+        cp = ControlPoint()
+        cp.load_snapshot(data).join()
+
+        [device] = cp.devices
+        assert device.location == alive.location
+        assert isinstance(device, GatewayDeviceV1)
+        assert device.devices[0].services[0].control_url == '/ctl/moved'
+
+        # The survivor has now been verified, so is fresh when saved.
+        restored = snapshot.loads(cp.save_snapshot())
+        assert restored.stale(300) == []
+
+    def test_different_device_is_discarded(self, get):
+        device = make_gateway(udn='uuid:old')
+        get.responses[device.location] = FakeResponse(
+            description('uuid:new', '/ctl/IPConn'))
+
+        data = snapshot.dumps([device], timestamp=time.time() - 3600)
+        cp = ControlPoint()
+        cp.load_snapshot(data).join()
+
+        assert cp.devices == []
+
+    def test_unverified_devices_stay_stale_when_saved(self, get):
+        data = snapshot.dumps([make_gateway()], timestamp=time.time() - 3600)
+
+        cp = ControlPoint()
+        cp.load_snapshot(data, max_age=None)
+        restored = snapshot.loads(cp.save_snapshot())
+
+        assert len(restored.stale(300)) == 1
+
+    def test_corrupt_record_does_not_break_control_point(self, get):
+        good = make_gateway('http://192.168.0.1:5000/a.xml')
+        bad = make_gateway('http://192.168.0.1:5000/b.xml')
+        data = bytearray(snapshot.dumps([bad, good]))
+        record = bytearray()
+        snapshot._encode_device(good, snapshot._StringTable(), record)
+        data[len(data) - (2 * len(record))] = 0x7F
+
+        cp = ControlPoint()
+        cp.load_snapshot(bytes(data))
+
+        assert [d.location for d in cp.devices] == [good.location]
+        restored = snapshot.loads(cp.save_snapshot())
+        assert restored.locations == [good.location]
+
+    def test_rediscovery_keeps_description(self, get):
+        cp = ControlPoint()
+        cp.load_snapshot(snapshot.dumps([make_gateway()]))
+
+        found = Device()
+        found.location = 'http://192.168.0.1:5000/rootDesc.xml'
+        found.server = 'New Server'
+        found.service_name = 'uuid:igd::upnp:rootdevice'
+        found.source_ip = '192.168.0.1'
+        found.source_port = 5001
+
+        device = cp._remember(found, time.time())
+
+        assert isinstance(device, GatewayDeviceV1)
+        assert device.server == 'New Server'
+        assert device.source_port == 5001
+        assert device.devices[0].source_port == 5001
+        assert device.devices[0].services[0].control_url == '/ctl/IPConn'
+        assert cp.devices == [device]
+
+    def test_more_specific_response_upgrades_device(self, get):
+        cp = ControlPoint()
+        now = time.time()
+
+        root = cp._remember(
+            discovery_response('upnp:rootdevice',
+                               'uuid:igd::upnp:rootdevice'), now)
+        gateway = cp._remember(
+            discovery_response(IGD, 'uuid:igd::' + IGD), now)
+
+        assert type(root) is Device
+        assert isinstance(gateway, GatewayDeviceV1)
+        assert cp.devices == [gateway]
+        assert gateway.search_target == IGD
+        assert gateway.service_name == 'uuid:igd::' + IGD
+
+    def test_less_specific_response_keeps_device(self, get):
+        cp = ControlPoint()
+        now = time.time()
+
+        gateway = cp._remember(
+            discovery_response(IGD, 'uuid:igd::' + IGD), now)
+        for st, usn in [('upnp:rootdevice', 'uuid:igd::upnp:rootdevice'),
+                        ('uuid:igd', 'uuid:igd')]:
+            assert cp._remember(discovery_response(st, usn), now) is gateway
+
+        assert cp.devices == [gateway]
+        assert gateway.search_target == IGD
+        assert gateway.service_name == 'uuid:igd::' + IGD
+
+        # And so it's saved, and later restored, as a gateway.
+        restored = snapshot.loads(cp.save_snapshot(), device_map)
+        assert isinstance(restored.devices()[0], GatewayDeviceV1)
+
+    def test_generic_device_is_verified_without_redescribing(self, get):
+        device = Device()
+        device.location = 'http://192.168.0.3:80/desc.xml'
+        device.udn = 'uuid:other'
+        get.responses[device.location] = FakeResponse(
+            description('uuid:other', '/ctl'))
+
+        data = snapshot.dumps([device], timestamp=time.time() - 3600)
+        cp = ControlPoint()
+        cp.load_snapshot(data).join()
+
+        [restored] = cp.devices
+        assert type(restored) is Device
+        assert snapshot.loads(cp.save_snapshot()).stale(300) == []
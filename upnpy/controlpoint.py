@@ -8,7 +8,11 @@ the API, and implements the bulk of the UPnP functionality.
 """
 import socket
 import random
+import threading
 import time
+import requests
+import xml.etree.ElementTree as ElementTree
+from . import scheduler, snapshot
 from .httpu import HTTPUResponse
 from .device import Device, GatewayDeviceV1, WANConnectionV1
 
@@ -19,6 +23,14 @@ HIGH_PORT = 65535
 # SSDP port
 SSDP_PORT = 1900
 
+# The age, in seconds, after which devices restored from a snapshot are
+# considered stale and revalidated. Ages are tracked per device, from when it
+# was last discovered or revalidated.
+SNAPSHOT_MAX_AGE = 300
+
+# The timeout, in seconds, for each request made when revalidating a device.
+REVALIDATE_TIMEOUT = 5
+
 #: The device map maps Search Target strings
 #: (e.g. 'urn:schemas-upnp-org:service:Layer3Forwarding:1') to the classes
 #: that should be used for those devices. If a search target string cannot be
@@ -51,6 +63,51 @@ def device_from_httpu_response(response):
     return dev
 
 
+def refresh_from_discovery(device, found):
+    """
+    Given a device we already know about and a freshly discovered device at the
+    same location, update the known device with anything discovery may have
+    changed. This keeps the known device's description, which discovery alone
+    doesn't provide.
+
+    :param device: The device we already know about.
+    :param found: The device just built from a discovery response.
+    """
+    # A device answers an ssdp:all search once for each thing it advertises
+    # (upnp:rootdevice, its UUID, its device type...), all from the same
+    # location. Only take the USN from the same advertisement we already have.
+    if found.search_target == device.search_target:
+        device.service_name = found.service_name
+
+    # Sub-devices inherit these from their parents when described, so keep
+    # them in step.
+    devices = [device]
+    while devices:
+        dev = devices.pop()
+        dev.server = found.server
+        dev.source_ip = found.source_ip
+        dev.source_port = found.source_port
+        devices.extend(dev.devices)
+
+    return
+
+
+def description_udn(xml):
+    """
+    Get the UDN of the root device from a device description, or ``None`` if
+    it doesn't have one.
+
+    :param xml: The description XML.
+    """
+    root = ElementTree.fromstring(xml)
+    namespace = root.tag.replace('root', '')
+
+    try:
+        return root.find(namespace + 'device').find(namespace + 'UDN').text
+    except AttributeError:
+        return None
+
+
 class ControlPoint(object):
     """
     Represents a single UPnP control point.
@@ -58,6 +115,29 @@ class ControlPoint(object):
     def __init__(self):
         self.__bind_sockets()
 
+        # Devices found by discovery, keyed by location URL.
+        self.__devices = {}
+
+        # When each device found by discovery was last seen, keyed by
+        # location URL.
+        self.__verified = {}
+
+        # Devices restored from a snapshot and not since rediscovered.
+        self.__snapshot = None
+
+    @property
+    def devices(self):
+        """
+        All the root devices known to this control point, whether discovered
+        or restored from a snapshot.
+        """
+        devices = list(self.__devices.values())
+
+        if self.__snapshot is not None:
+            devices.extend(self.__snapshot.devices())
+
+        return devices
+
     def __bind_sockets(self):
         """
         Bind any necessary sockets.
@@ -99,8 +179,163 @@ class ControlPoint(object):
         # Build the devices.
         devices = [device_from_httpu_response(packet) for packet in packets]
 
+        # Remember them. Where we already know about a device, from an earlier
+        # discovery or a snapshot, keep that one: it may have been described.
+        now = time.time()
+        devices = [self._remember(device, now) for device in devices]
+
         return devices
 
+    def _remember(self, found, now):
+        """
+        Remember a device found by discovery, returning the device object that
+        now represents it.
+
+        :param found: The device built from the discovery response.
+        :param now: The time the device was discovered.
+        """
+        location = found.location
+        device = self.__devices.get(location)
+
+        if (device is None) and (self.__snapshot is not None):
+            try:
+                device = self.__snapshot.device(location)
+            except KeyError:
+                pass
+
+            self.__snapshot.discard(location)
+
+        # Prefer the more specific class if this response's Search Target has
+        # one, e.g. the IGD URN after upnp:rootdevice. A generic device is
+        # never described, so there's nothing lost by replacing it.
+        found_cls = type(found)
+        if (device is None) or ((found_cls is not type(device)) and
+                                issubclass(found_cls, type(device))):
+            device = found
+        else:
+            refresh_from_discovery(device, found)
+
+        self.__devices[location] = device
+        self.__verified[location] = now
+
+        return device
+
+    def save_snapshot(self):
+        """
+        Serialize every known device, along with its services and sub-devices,
+        into a compact binary snapshot suitable for :meth:`load_snapshot`.
+        Each device is stored with the time it was last known to be present,
+        so devices carried over from an unverified snapshot stay stale.
+        """
+        devices = list(self.__devices.values())
+        verified = dict(self.__verified)
+        restored = self.__snapshot
+
+        if restored is not None:
+            for location in restored.locations:
+                # The device may be discarded by revalidation while we're
+                # looking at it.
+                try:
+                    device = restored.device(location)
+                    verified[location] = restored.verified(location)
+                except KeyError:
+                    continue
+
+                devices.append(device)
+
+        return snapshot.dumps(devices, verified=verified)
+
+    def load_snapshot(self, data, max_age=SNAPSHOT_MAX_AGE):
+        """
+        Restore devices from a snapshot produced by :meth:`save_snapshot`.
+        Devices are only decoded when first used. Any device that hasn't been
+        seen for more than ``max_age`` seconds is revalidated in a background
+        thread, and dropped if it can no longer be reached or a different
+        device now answers at its location.
+
+        Returns the revalidation thread, or ``None`` if every device is fresh.
+
+        :param data: The snapshot bytes.
+        :param max_age: (optional) The age in seconds beyond which the
+                        snapshot's devices are revalidated. Pass ``None`` to
+                        never revalidate.
+        """
+        restored = snapshot.loads(data, device_map)
+
+        # Anything we've discovered ourselves is fresher than the snapshot.
+        for location in self.__devices:
+            restored.discard(location)
+
+        self.__snapshot = restored
+
+        if max_age is None:
+            return None
+
+        stale = restored.stale(max_age)
+        if not stale:
+            return None
+
+        thread = threading.Thread(target=self._revalidate,
+                                  args=(restored, stale))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _revalidate(self, restored, locations):
+        """
+        Check that each of the given devices in a restored snapshot still
+        serves its description, and that it's still the same device. Devices
+        that pass are re-described where possible, so their URLs are current.
+        Devices that fail are discarded.
+
+        :param restored: The :class:`Snapshot <upnpy.snapshot.Snapshot>` to
+                         revalidate.
+        :param locations: The location URLs of the devices to revalidate.
+        """
+        for location in locations:
+            # Skip anything rediscovered since we started.
+            try:
+                device = restored.device(location)
+            except KeyError:
+                continue
+
+            try:
+                r = scheduler.get(location, timeout=REVALIDATE_TIMEOUT)
+                r.raise_for_status()
+                udn = description_udn(r.text)
+            except (requests.RequestException, ElementTree.ParseError):
+                restored.discard(location)
+                continue
+
+            known_udn = getattr(device, 'udn', None)
+            if (known_udn is not None) and (udn != known_udn):
+                restored.discard(location)
+                continue
+
+            # Describe a fresh copy rather than the restored device, so that
+            # nobody sees a half-described device.
+            fresh = type(device)()
+            fresh.server = device.server
+            fresh.service_name = device.service_name
+            fresh.search_target = device.search_target
+            fresh.location = device.location
+            fresh.source_ip = device.source_ip
+            fresh.source_port = device.source_port
+
+            try:
+                described = fresh.describe_from_xml(r.text)
+            except (ValueError, AttributeError):
+                # The description is malformed.
+                restored.discard(location)
+                continue
+
+            if described:
+                restored.replace(location, fresh)
+
+            restored.mark_verified(location)
+
+        return
+
     def _listen_for_discover(self, duration):
         """
         Listen for responses to the discovery packet for a number of seconds up
@@ -10,7 +10,7 @@ A "device" is a slightly abstract notion in UPnP, and does not directly
 correspond to a network element. Any given network element may actually be
 multiple UPnP devices, or may be only a single UPnP device.
 """
-import requests
+from .. import scheduler
 from ..utils import camelcase_to_underscore
 from ..servicemapping import init_service
 
@@ -58,10 +58,21 @@ class Device(object):
         Retrieve the device description. In this case, for an unknown device,
         we just return the XML.
         """
-        desc = requests.get(self.location)
+        desc = scheduler.get(self.location)
         desc.raise_for_status()
         return desc.text
 
+    def describe_from_xml(self, xml):
+        """
+        Populate the device object from its description XML. Returns whether
+        the device was described. Unknown devices don't know how to interpret
+        their descriptions, so this does nothing and returns ``False``:
+        subclasses that can should override it.
+
+        :param xml: The description XML, as served from ``self.location``.
+        """
+        return False
+
     def describe_from_xml_node(self, node, parent, namespace):
         """
         Describe the device from the XML node representing it in some parent
@@ -6,10 +6,10 @@ gatewaydevice.py
 This is an implementation of the Internet Gateway Device v1.0 specification.
 It explicitly knows how to parse the XML device description for IGDs.
 """
-import requests
 import xml.etree.ElementTree as ElementTree
 from .device import Device
 from .wandevice import WANDeviceV1
+from .. import scheduler
 from ..utils import camelcase_to_underscore
 from ..servicemapping import init_service
 
@@ -32,9 +32,19 @@ class GatewayDeviceV1(Device):
         Retrieve the device description and use it to populate the device
         object.
         """
-        r = requests.get(self.location)
+        r = scheduler.get(self.location)
         r.raise_for_status()
-        root = ElementTree.fromstring(r.text)
+        self.describe_from_xml(r.text)
+
+        return
+
+    def describe_from_xml(self, xml):
+        """
+        Populate the device object from its description XML. Returns ``True``.
+
+        :param xml: The description XML, as served from ``self.location``.
+        """
+        root = ElementTree.fromstring(xml)
 
         # Save off the namespace, which ElementTree obnoxiously prepends to all
         # the node names.
@@ -45,7 +55,7 @@ class GatewayDeviceV1(Device):
 
         self._describe_device(root)
 
-        return
+        return True
 
     def _set_base_url(self, root):
         """
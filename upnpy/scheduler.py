@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""
+scheduler.py
+~~~~~~~~~~~~
+
+Schedules HTTP traffic to UPnP devices. Consumer routers fall over if you
+hammer them, so every description and control request goes through a
+per-device scheduler that:
+
+- spaces requests out at a rate it learns from each device, increasing it
+  while responses stay quick and cutting it back when latency climbs or
+  requests fail (additive increase, multiplicative decrease), and remembering
+  roughly where the device started failing so we don't keep knocking it over;
+- limits the number of requests in flight to each device;
+- applies a timeout to every request, so hung connections don't hang us; and
+- opens a circuit breaker after repeated failures, refusing further requests
+  to that device until a single probe request succeeds.
+
+Devices are identified by the host and port of the URL being requested.
+"""
+import threading
+import time
+import requests
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+# The request rates, in requests per second, that a device starts at and is
+# kept between.
+INITIAL_RATE = 5.0
+MIN_RATE     = 0.5
+MAX_RATE     = 50.0
+
+# The amount the rate grows by after each healthy response, and the factor it
+# is multiplied by when the device shows signs of strain.
+RATE_INCREASE = 0.5
+RATE_DECREASE = 0.5
+
+# When a device fails in a way that suggests overload, we remember this
+# fraction of the rate it failed at as its ceiling, and don't grow past it.
+# Once at the ceiling, the ceiling itself grows by roughly this fraction per
+# second so that we can find out if the device has got healthier.
+CEILING_FACTOR = 0.8
+CEILING_GROWTH = 0.001
+
+# A device is considered strained when the smoothed latency of a kind of
+# request (method and path) exceeds this multiple of that kind's baseline.
+LATENCY_FACTOR = 3.0
+
+# The smoothing factor for the latency moving average.
+LATENCY_ALPHA = 0.2
+
+# The smoothing factor for the baseline latency. This is a much slower moving
+# average than the one above, so that sustained slowdowns show up as strain
+# while a single unusually quick or slow response barely moves it.
+BASELINE_ALPHA = 0.02
+
+# The maximum number of requests in flight to a single device.
+MAX_IN_FLIGHT = 1
+
+# The default timeout, in seconds, applied to every request.
+REQUEST_TIMEOUT = 10
+
+# The number of consecutive failures that opens a device's circuit breaker,
+# and the initial and maximum number of seconds it stays open for. The open
+# period doubles each time a probe request fails.
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT     = 5.0
+MAX_RESET_TIMEOUT = 300.0
+
+# Status codes that indicate the device itself is struggling. Note that 500
+# isn't one: UPnP devices report ordinary SOAP faults with it.
+FAILURE_STATUS_CODES = (502, 503, 504)
+
+# Circuit breaker states.
+CLOSED    = 'closed'
+OPEN      = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """
+    Raised when a request is refused because the device's circuit breaker is
+    open. This subclasses the Requests ``ConnectionError``, so code that
+    already handles unreachable devices handles this too.
+    """
+
+
+class DeviceState(object):
+    """
+    The scheduling state for a single device.
+
+    :param clock: A function returning the current time in seconds.
+    :param max_in_flight: The maximum number of concurrent requests.
+    """
+    def __init__(self, clock, max_in_flight=MAX_IN_FLIGHT):
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        self.__in_flight = threading.BoundedSemaphore(max_in_flight)
+
+        #: The current permitted request rate, in requests per second.
+        self.rate = INITIAL_RATE
+
+        #: The highest rate we believe the device can sustain.
+        self.ceiling = MAX_RATE
+
+        #: A mapping of request kinds (e.g. 'POST /ctl') to a list of the
+        #: smoothed and baseline latencies for that kind, in seconds.
+        self.latencies = {}
+
+        #: The state of the circuit breaker.
+        self.state = CLOSED
+
+        #: The number of failures since the last success.
+        self.failures = 0
+
+        # The earliest time at which the next request may be sent.
+        self.__next_slot = 0.0
+
+        # When an open circuit breaker may next let a probe through, and how
+        # long it will stay open for next time.
+        self.__open_until = 0.0
+        self.__reset_timeout = RESET_TIMEOUT
+
+    def acquire(self):
+        """
+        Reserve the next send slot for this device. Returns a tuple of the
+        number of seconds the caller must wait before sending, and whether the
+        request is the circuit breaker's probe. Raises
+        :class:`CircuitOpenError` if the circuit breaker is open.
+        """
+        probe = False
+
+        with self.__lock:
+            now = self.__clock()
+
+            if self.state == OPEN:
+                if now < self.__open_until:
+                    raise CircuitOpenError('Circuit breaker open.')
+
+                # Let exactly one probe through.
+                self.state = HALF_OPEN
+                probe = True
+            elif self.state == HALF_OPEN:
+                raise CircuitOpenError('Circuit breaker probe in flight.')
+
+            slot = max(now, self.__next_slot)
+            self.__next_slot = slot + (1.0 / self.rate)
+
+        return slot - now, probe
+
+    def check(self, probe):
+        """
+        Check that a request holding a slot may still be sent. The breaker may
+        have opened while the request waited for its slot, in which case this
+        raises :class:`CircuitOpenError`.
+
+        :param probe: Whether the request is the circuit breaker's probe.
+        """
+        with self.__lock:
+            if self.state == OPEN:
+                raise CircuitOpenError('Circuit breaker open.')
+            elif (self.state == HALF_OPEN) and not probe:
+                raise CircuitOpenError('Circuit breaker probe in flight.')
+
+    def record_success(self, latency, kind=None):
+        """
+        Update the state after a healthy response.
+
+        :param latency: The time the request took, in seconds.
+        :param kind: (optional) The kind of request, e.g. 'POST /ctl'. Latency
+                     is only compared between requests of the same kind.
+        """
+        with self.__lock:
+            self.failures = 0
+
+            if self.state == HALF_OPEN:
+                # The device has come back. Whatever took it down may not have
+                # been us, so don't hold it to a ceiling learned beforehand.
+                self.state = CLOSED
+                self.__reset_timeout = RESET_TIMEOUT
+                self.ceiling = max(self.ceiling, INITIAL_RATE)
+                self.rate = INITIAL_RATE
+
+            try:
+                stats = self.latencies[kind]
+            except KeyError:
+                stats = self.latencies[kind] = [latency, latency]
+
+            # Judge strain against the baseline as it stood before this
+            # response, then let the response nudge the baseline.
+            stats[0] += LATENCY_ALPHA * (latency - stats[0])
+            strained = stats[0] > LATENCY_FACTOR * stats[1]
+            stats[1] += BASELINE_ALPHA * (latency - stats[1])
+
+            if strained:
+                self.__slow_down()
+            elif self.rate < self.ceiling:
+                self.rate = min(self.rate + RATE_INCREASE, self.ceiling)
+            else:
+                growth = 1 + (CEILING_GROWTH / self.rate)
+                self.ceiling = min(self.ceiling * growth, MAX_RATE)
+                self.rate = self.ceiling
+
+    def record_failure(self, strained=True):
+        """
+        Update the state after a failed request.
+
+        :param strained: (optional) Whether the failure suggests the device was
+                         overloaded, as opposed to unreachable.
+        """
+        with self.__lock:
+            # Only the first failure in a run tells us anything about the
+            # rate the device can take: the rest are just it being down.
+            if strained and (self.failures == 0):
+                self.ceiling = max(self.rate * CEILING_FACTOR, MIN_RATE)
+
+            self.failures += 1
+            self.__slow_down()
+
+            if self.state == HALF_OPEN:
+                self.__reset_timeout = min(self.__reset_timeout * 2,
+                                           MAX_RESET_TIMEOUT)
+                self.__open()
+            elif self.failures >= FAILURE_THRESHOLD:
+                self.__open()
+
+    def abandon(self, probe):
+        """
+        Update the state after a request that was given a slot but finished
+        without telling us anything about the device. If it was the circuit
+        breaker's probe, the next request becomes the probe instead.
+
+        :param probe: Whether the request was the circuit breaker's probe.
+        """
+        with self.__lock:
+            if probe and (self.state == HALF_OPEN):
+                self.state = OPEN
+
+    def release(self):
+        """
+        Mark an in-flight request as complete.
+        """
+        self.__in_flight.release()
+
+    def wait_in_flight(self):
+        """
+        Block until this device can accept another concurrent request.
+        """
+        self.__in_flight.acquire()
+
+    def __slow_down(self):
+        """
+        Multiplicatively decrease the request rate. Must hold the lock.
+        """
+        self.rate = max(self.rate * RATE_DECREASE, MIN_RATE)
+
+    def __open(self):
+        """
+        Open the circuit breaker. Must hold the lock.
+        """
+        self.state = OPEN
+        self.__open_until = self.__clock() + self.__reset_timeout
+
+
+class Scheduler(object):
+    """
+    Schedules requests to UPnP devices, keeping separate state for each
+    device.
+
+    :param session: (optional) The Requests session (or anything with a
+                    compatible ``request`` method) used to send requests. If
+                    not provided, each thread gets its own Requests session,
+                    since sessions aren't safe to share between threads.
+    :param clock: (optional) A function returning the current time in seconds.
+    :param sleep: (optional) A function that sleeps for a number of seconds.
+    :param timeout: (optional) The default timeout for each request.
+    :param max_in_flight: (optional) The maximum number of concurrent requests
+                          to each device.
+    """
+    def __init__(self,
+                 session=None,
+                 clock=time.time,
+                 sleep=time.sleep,
+                 timeout=REQUEST_TIMEOUT,
+                 max_in_flight=MAX_IN_FLIGHT):
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__session = session
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__devices = {}
+
+    def session(self):
+        """
+        Get the session to send requests with from the current thread.
+        """
+        if self.__session is not None:
+            return self.__session
+
+        try:
+            return self.__local.session
+        except AttributeError:
+            self.__local.session = requests.Session()
+            return self.__local.session
+
+    def device_state(self, url):
+        """
+        Get the :class:`DeviceState` for the device serving ``url``.
+
+        :param url: Any URL served by the device.
+        """
+        key = urlparse(url).netloc
+
+        with self.__lock:
+            try:
+                return self.__devices[key]
+            except KeyError:
+                state = DeviceState(self.__clock, self.max_in_flight)
+                self.__devices[key] = state
+                return state
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request once the device serving ``url`` is ready for it.
+        Accepts the same arguments as ``requests.request``, and returns the
+        Requests :class:`Response <requests.Response>`.
+
+        :param method: The HTTP method.
+        :param url: The URL to request.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        state = self.device_state(url)
+        kind = method + ' ' + urlparse(url).path
+
+        # Once we hold a slot, the outcome must always be recorded: otherwise
+        # a circuit breaker probe could leave the breaker half-open forever.
+        delay, probe = state.acquire()
+        settled = False
+
+        try:
+            if delay > 0:
+                self.__sleep(delay)
+
+            # The breaker may have opened while we were queued, so check again
+            # after each wait rather than sending to a device we think is down.
+            state.check(probe)
+            state.wait_in_flight()
+            try:
+                state.check(probe)
+                start = self.__clock()
+
+                # Only failures to talk to the device count against it. A
+                # refused or unreachable device is down, not overloaded (note
+                # that ConnectTimeout is a ConnectionError). A device that
+                # accepted the request and then hung may be overloaded, but
+                # only if we were pushing it harder than we start out at.
+                try:
+                    r = self.session().request(method, url, **kwargs)
+                except requests.ConnectionError:
+                    state.record_failure(strained=False)
+                    settled = True
+                    raise
+                except requests.Timeout:
+                    state.record_failure(strained=state.rate > INITIAL_RATE)
+                    settled = True
+                    raise
+
+                # Record the outcome before letting the next request in, so
+                # that it sees the breaker open if this opened it.
+                if r.status_code in FAILURE_STATUS_CODES:
+                    state.record_failure(strained=True)
+                else:
+                    state.record_success(self.__clock() - start, kind)
+                settled = True
+            finally:
+                state.release()
+        finally:
+            if not settled:
+                state.abandon(probe)
+
+        return r
+
+    def get(self, url, **kwargs):
+        """
+        Schedule a GET request. See :meth:`request`.
+        """
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """
+        Schedule a POST request. See :meth:`request`.
+        """
+        return self.request('POST', url, **kwargs)
+
+
+#: The scheduler shared by all UPnPy devices and services.
+default_scheduler = Scheduler()
+
+
+def get(url, **kwargs):
+    """
+    Schedule a GET request on the default scheduler.
+    """
+    return default_scheduler.get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    """
+    Schedule a POST request on the default scheduler.
+    """
+    return default_scheduler.post(url, **kwargs)
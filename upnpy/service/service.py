@@ -6,8 +6,8 @@ service.py
 Define a base Service class. This is the class that is used when we don't know
 anything about a given Service.
 """
-import requests
 import xml.etree.ElementTree as ET
+from .. import scheduler
 from ..utils import get_SOAP_RPC_base
 
 
@@ -55,7 +55,8 @@ class Service(object):
         device.
 
         Returns the Reqeusts :class:`Response <requests.Response>` object from
-        the HTTP POST.
+        the HTTP POST. Raises :class:`CircuitOpenError
+        <upnpy.scheduler.CircuitOpenError>` if the device has been failing.
 
         :param action_name: The name (including version) of the action to
                             perform.
@@ -96,7 +97,8 @@ class Service(object):
         post_body = '<?xml version="1.0"?>'
         post_body += ET.tostring(root)
 
-        # Now post it.
+        # Now post it. This goes through the scheduler so that we don't
+        # overwhelm the device.
         url = self.parent.base_url + self.control_url
 
-        return requests.post(url, headers=headers, body=post_body)
+        return scheduler.post(url, headers=headers, data=post_body)
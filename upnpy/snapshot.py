@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+"""
+snapshot.py
+~~~~~~~~~~~
+
+Serializes a discovered device topology into a compact, versioned binary
+snapshot, and loads it back again. This lets a control point skip the whole
+discovery and description dance when it restarts.
+
+The format is deliberately simple. All integers are unsigned LEB128 varints
+unless otherwise noted.
+
+    header        '>8sBd': magic, format version, creation time (seconds)
+    string table  count, then (length, UTF-8 bytes) for each string
+    index         count, then (location, verified, record length) for each
+                  root device
+    records       one record per root device, back to back
+
+``verified`` is the time, in whole seconds since the epoch, at which the root
+device was last known to be present. This is tracked per device because a
+snapshot may contain devices carried over from an older snapshot that nobody
+has checked since.
+
+Every string in the snapshot lives in the string table exactly once, and is
+referred to elsewhere by its index plus one. Zero means "absent". A device
+record is a reference for each of ``DEVICE_FIELDS``, the source port (plus
+one), the service count, a reference for each of ``SERVICE_FIELDS`` for each
+service, and finally the sub-device count followed by each sub-device record.
+
+The index lets us decode root devices lazily: nothing beyond the string table
+is parsed until somebody actually asks for a device.
+"""
+import struct
+import threading
+import time
+from .device import Device
+from .servicemapping import service_map
+from .service import Service
+
+#: The magic bytes at the start of every snapshot.
+MAGIC = b'UPNPSNAP'
+
+#: The current snapshot format version.
+VERSION = 2
+
+HEADER = struct.Struct('>8sBd')
+
+#: The device attributes stored in a snapshot, in order. Attributes that are
+#: missing from a device (e.g. because it was never described) are recorded
+#: as absent and are not set when the device is restored.
+DEVICE_FIELDS = ['server', 'service_name', 'search_target', 'location',
+                 'source_ip', 'base_url', 'device_type', 'friendly_name',
+                 'manufacturer', 'manufacturer_url', 'model_description',
+                 'model_name', 'model_number', 'model_url', 'serial_number',
+                 'udn', 'upc', 'presentation_url']
+
+#: The service attributes stored in a snapshot, in order.
+SERVICE_FIELDS = ['service_type', 'service_id', 'scpdurl', 'control_url',
+                  'event_sub_url']
+
+
+def _write_varint(out, value):
+    """
+    Append ``value`` to the bytearray ``out`` as an unsigned LEB128 varint.
+    """
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, offset):
+    """
+    Read an unsigned LEB128 varint from the bytearray ``data``. Returns a tuple
+    of the value and the offset of the next byte.
+    """
+    value = 0
+    shift = 0
+
+    while True:
+        try:
+            byte = data[offset]
+        except IndexError:
+            raise ValueError('Malformed snapshot: truncated varint.')
+
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+
+        if not byte & 0x80:
+            return value, offset
+
+
+class _StringTable(object):
+    """
+    Interns strings while a snapshot is being written.
+    """
+    def __init__(self):
+        self.strings = []
+        self.__refs = {}
+
+    def ref(self, value):
+        """
+        Return the reference for ``value``, adding it to the table if needed.
+        ``None`` is always encoded as zero.
+        """
+        if value is None:
+            return 0
+
+        try:
+            return self.__refs[value]
+        except KeyError:
+            self.strings.append(value)
+            self.__refs[value] = len(self.strings)
+            return self.__refs[value]
+
+
+def _encode_device(device, strings, out):
+    """
+    Append the record for ``device`` and all of its children to ``out``.
+    """
+    for field in DEVICE_FIELDS:
+        _write_varint(out, strings.ref(getattr(device, field, None)))
+
+    port = device.source_port
+    _write_varint(out, 0 if port is None else int(port) + 1)
+
+    _write_varint(out, len(device.services))
+    for service in device.services:
+        for field in SERVICE_FIELDS:
+            _write_varint(out, strings.ref(getattr(service, field, None)))
+
+    _write_varint(out, len(device.devices))
+    for sub_device in device.devices:
+        _encode_device(sub_device, strings, out)
+
+
+def dumps(devices, timestamp=None, verified=None):
+    """
+    Serialize a list of root devices, including all their services and
+    sub-devices, into a binary snapshot.
+
+    :param devices: The root devices to store.
+    :param timestamp: (optional) The time the snapshot was taken, in seconds
+                      since the epoch. Defaults to now.
+    :param verified: (optional) A mapping of location URLs to the time each
+                     root device was last known to be present. Devices not in
+                     the mapping are assumed to have been present at
+                     ``timestamp``.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+
+    verified = verified or {}
+
+    strings = _StringTable()
+    records = []
+
+    for device in devices:
+        record = bytearray()
+        _encode_device(device, strings, record)
+        when = verified.get(device.location, timestamp)
+        records.append((strings.ref(device.location), int(when), record))
+
+    out = bytearray(HEADER.pack(MAGIC, VERSION, timestamp))
+
+    _write_varint(out, len(strings.strings))
+    for string in strings.strings:
+        encoded = string.encode('utf-8')
+        _write_varint(out, len(encoded))
+        out.extend(encoded)
+
+    _write_varint(out, len(records))
+    for location, when, record in records:
+        _write_varint(out, location)
+        _write_varint(out, when)
+        _write_varint(out, len(record))
+
+    for _, _, record in records:
+        out.extend(record)
+
+    return bytes(out)
+
+
+def loads(data, device_map=None):
+    """
+    Parse a binary snapshot. Only the header, string table and index are
+    decoded here: the devices themselves are decoded on first access.
+
+    :param data: The snapshot bytes, as returned by :func:`dumps`.
+    :param device_map: (optional) A mapping of Search Target strings to the
+                       classes used for root devices.
+    """
+    return Snapshot(data, device_map)
+
+
+class Snapshot(object):
+    """
+    A lazily-decoded device topology snapshot. Behaves like a collection of
+    root devices, keyed by their location URLs.
+
+    :param data: The snapshot bytes, as returned by :func:`dumps`.
+    :param device_map: (optional) A mapping of Search Target strings to the
+                       classes used for root devices.
+    """
+    def __init__(self, data, device_map=None):
+        self.__data = bytearray(data)
+        self.__device_map = device_map or {}
+        self.__lock = threading.Lock()
+
+        if len(self.__data) < HEADER.size:
+            raise ValueError('Malformed snapshot: truncated header.')
+
+        magic, version, timestamp = HEADER.unpack_from(bytes(self.__data), 0)
+
+        if magic != MAGIC:
+            raise ValueError('Not a UPnPy snapshot.')
+        if version != VERSION:
+            raise ValueError('Unsupported snapshot version %d.' % version)
+
+        #: The format version of the snapshot.
+        self.version = version
+
+        #: The time the snapshot was taken.
+        self.timestamp = timestamp
+
+        offset = HEADER.size
+        count, offset = _read_varint(self.__data, offset)
+        self.__strings = []
+
+        for _ in range(count):
+            length, offset = _read_varint(self.__data, offset)
+            end = offset + length
+
+            if end > len(self.__data):
+                raise ValueError('Malformed snapshot: truncated string.')
+
+            raw = bytes(self.__data[offset:end])
+            self.__strings.append(raw.decode('utf-8'))
+            offset = end
+
+        count, offset = _read_varint(self.__data, offset)
+        index = []
+
+        for _ in range(count):
+            location, offset = _read_varint(self.__data, offset)
+            when, offset = _read_varint(self.__data, offset)
+            length, offset = _read_varint(self.__data, offset)
+            index.append((self.__string(location), when, length))
+
+        # Records follow the index back to back, so their offsets follow from
+        # their lengths.
+        self.__entries = {}
+        self.__verified = {}
+        self.__order = []
+
+        for location, when, length in index:
+            self.__entries[location] = (offset, length)
+            self.__verified[location] = when
+            self.__order.append(location)
+            offset += length
+
+        if offset > len(self.__data):
+            raise ValueError('Malformed snapshot: truncated records.')
+
+        self.__decoded = {}
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__order)
+
+    def __contains__(self, location):
+        with self.__lock:
+            return location in self.__entries
+
+    def __iter__(self):
+        return iter(self.devices())
+
+    @property
+    def locations(self):
+        """
+        The location URLs of the root devices still in the snapshot.
+        """
+        with self.__lock:
+            return list(self.__order)
+
+    def verified(self, location):
+        """
+        The time at which the root device at ``location`` was last known to be
+        present. Raises ``KeyError`` if there is no such device.
+
+        :param location: The location URL of the device.
+        """
+        with self.__lock:
+            return self.__verified[location]
+
+    def mark_verified(self, location, when=None):
+        """
+        Record that the root device at ``location`` is known to be present.
+
+        :param location: The location URL of the device.
+        :param when: (optional) The time it was seen. Defaults to now.
+        """
+        with self.__lock:
+            if location in self.__entries:
+                if when is None:
+                    when = time.time()
+                self.__verified[location] = when
+
+    def stale(self, max_age):
+        """
+        The location URLs of root devices that haven't been verified within
+        the last ``max_age`` seconds.
+
+        :param max_age: The maximum age in seconds.
+        """
+        cutoff = time.time() - max_age
+
+        with self.__lock:
+            return [l for l in self.__order if self.__verified[l] < cutoff]
+
+    def device(self, location):
+        """
+        Get the root device at ``location``, decoding it if necessary. Raises
+        ``KeyError`` if there is no such device, including if its record turns
+        out to be corrupt, in which case it's discarded.
+
+        :param location: The location URL of the device.
+        """
+        with self.__lock:
+            try:
+                return self.__decoded[location]
+            except KeyError:
+                pass
+
+            offset, length = self.__entries[location]
+
+            # Decode from a copy of just this record, so that a corrupt record
+            # can't run on into its neighbours. If it's corrupt, drop it, so
+            # that one bad record doesn't break the rest of the snapshot.
+            record = self.__data[offset:offset + length]
+
+            try:
+                device, end = self.__decode_device(record, 0, None)
+                if end != length:
+                    raise ValueError('Malformed snapshot: bad record length.')
+            except ValueError:
+                self.__remove(location)
+                raise KeyError(location)
+
+            self.__decoded[location] = device
+            return device
+
+    def devices(self):
+        """
+        Get all the root devices still in the snapshot, decoding any that
+        haven't been decoded yet.
+        """
+        devices = []
+
+        for location in self.locations:
+            try:
+                devices.append(self.device(location))
+            except KeyError:
+                # Discarded while we were iterating.
+                pass
+
+        return devices
+
+    def replace(self, location, device):
+        """
+        Replace the root device at ``location`` with a freshly described copy,
+        if it's still in the snapshot.
+
+        :param location: The location URL of the device.
+        :param device: The replacement device.
+        """
+        with self.__lock:
+            if location in self.__entries:
+                self.__decoded[location] = device
+
+    def discard(self, location):
+        """
+        Remove the root device at ``location`` from the snapshot, if present.
+        Used when a device has gone away, or has been rediscovered.
+
+        :param location: The location URL of the device.
+        """
+        with self.__lock:
+            self.__remove(location)
+
+    def __remove(self, location):
+        """
+        Remove the root device at ``location``, if present. Must hold the lock.
+        """
+        if self.__entries.pop(location, None) is not None:
+            self.__order.remove(location)
+            del self.__verified[location]
+        self.__decoded.pop(location, None)
+
+    def __string(self, ref):
+        """
+        Resolve a string table reference.
+        """
+        if ref == 0:
+            return None
+
+        try:
+            return self.__strings[ref - 1]
+        except IndexError:
+            raise ValueError('Malformed snapshot: bad string reference.')
+
+    def __decode_device(self, data, offset, parent):
+        """
+        Decode the device record at ``offset`` in ``data``. Returns a tuple of
+        the device and the offset of the next byte.
+        """
+        values = {}
+        for field in DEVICE_FIELDS:
+            ref, offset = _read_varint(data, offset)
+            if ref:
+                values[field] = self.__string(ref)
+
+        # Pick the class the same way discovery and description would.
+        if parent is None:
+            cls = self.__device_map.get(values.get('search_target'), Device)
+        else:
+            cls = parent.sub_device_map.get(values.get('device_type'), Device)
+
+        device = cls()
+        device.parent = parent
+        for field, value in values.items():
+            setattr(device, field, value)
+
+        port, offset = _read_varint(data, offset)
+        device.source_port = port - 1 if port else None
+
+        count, offset = _read_varint(data, offset)
+        for _ in range(count):
+            service, offset = self.__decode_service(data, offset, device)
+            device.services.append(service)
+
+        count, offset = _read_varint(data, offset)
+        for _ in range(count):
+            sub_device, offset = self.__decode_device(data, offset, device)
+            device.devices.append(sub_device)
+
+        return device, offset
+
+    def __decode_service(self, data, offset, parent):
+        """
+        Decode the service record at ``offset`` in ``data``. Returns a tuple of
+        the service and the offset of the next byte.
+        """
+        values = {}
+        for field in SERVICE_FIELDS:
+            ref, offset = _read_varint(data, offset)
+            values[field] = self.__string(ref)
+
+        cls = service_map.get(values['service_type'], Service)
+
+        # Services are normally built from their XML description, which we
+        # don't have, so bypass __init__ and populate the attributes directly.
+        service = cls.__new__(cls)
+        service.parent = parent
+        for field, value in values.items():
+            setattr(service, field, value)
+
+        return service, offset